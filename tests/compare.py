@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 #
 # compare.py -- High-level tests for dtrx.
@@ -17,9 +17,13 @@
 # You should have received a copy of the GNU General Public License along
 # with this program; if not, see <http://www.gnu.org/licenses/>.
 
+import collections
 import fcntl
+import io
+import multiprocessing
 import os
 import re
+import shutil
 import struct
 import subprocess
 import sys
@@ -28,16 +32,17 @@ import termios
 import yaml
 
 try:
-    set
-except NameError:
-    from sets import Set as set
+    # The libyaml-based loader is much faster, if PyYAML was built with it.
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 if os.path.exists('scripts/dtrx') and os.path.exists('tests'):
     os.chdir('tests')
 elif os.path.exists('../scripts/dtrx') and os.path.exists('../tests'):
     pass
 else:
-    print "ERROR: Can't run tests in this directory!"
+    print("ERROR: Can't run tests in this directory!")
     sys.exit(2)
 
 DTRX_SCRIPT = os.path.realpath('../scripts/dtrx')
@@ -49,33 +54,56 @@ class ExtractorTestError(Exception):
     pass
 
 
+def remove_tree(path):
+    # Tests can leave behind directories we aren't allowed to read or
+    # write.  Open them up on the way down, like chmod -R would, so
+    # rmtree can get everything.
+    try:
+        os.chmod(path, 0o700)
+    except OSError:
+        pass
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames:
+            subdir = os.path.join(dirpath, name)
+            if not os.path.islink(subdir):
+                try:
+                    os.chmod(subdir, 0o700)
+                except OSError:
+                    pass
+    shutil.rmtree(path, ignore_errors=True)
+
+
 class StatusWriter(object):
     def __init__(self):
         try:
-            size = fcntl.ioctl(sys.stdout.fileno(), termios.TIOCGWINSZ,
-                               struct.pack("HHHH", 0, 0, 0, 0))
+            fcntl.ioctl(sys.stdout.fileno(), termios.TIOCGWINSZ,
+                        struct.pack("HHHH", 0, 0, 0, 0))
         except IOError:
             self.show = self.show_file
         else:
-            self.width = struct.unpack("HHHH", size)[1] - 1
-            self.last_width = self.width
+            self.last_message = None
             self.show = self.show_term
 
     def show_term(self, message):
-        sys.stdout.write(message.ljust(self.last_width) + "\r")
+        # The line already says this; don't spend a write and flush on it.
+        if message == self.last_message:
+            return
+        # Have the terminal erase the old line instead of padding over it.
+        sys.stdout.write("\x1b[2K" + message + "\r")
         sys.stdout.flush()
-        self.last_width = max(self.width, len(message))
+        self.last_message = message
 
     def show_file(self, message):
         if message:
-            print message
+            print(message)
 
     def clear(self):
         self.show("")
         
 
 class ExtractorTest(object):
-    status_writer = StatusWriter()
+    # Maps baseline_key values to the results their shell baseline gave.
+    baseline_cache = {}
 
     def __init__(self, **kwargs):
         global NUM_TESTS
@@ -92,99 +120,126 @@ class ExtractorTest(object):
             if isinstance(value, str):
                 value = [value]
             setattr(self, key, value)
+            setattr(self, key + '_res',
+                    [re.compile(pattern.replace(' ', '\\s+'), re.MULTILINE)
+                     for pattern in value])
         if self.input and (not self.input.endswith('\n')):
             self.input = self.input + '\n'
-
-    def start_proc(self, command, stdin=None, output=None):
-        process = subprocess.Popen(command, stdin=subprocess.PIPE,
-                                   stdout=output, stderr=output)
-        if stdin:
-            process.stdin.write(stdin)
-        process.stdin.close()
-        return process
+        # Several tests check different dtrx options against the same
+        # baseline.  Everything that can change its results is here.  Only
+        # tests with their own directory start from an empty one every time;
+        # other tests list the whole tests directory, where anything an
+        # earlier test left behind would make a saved listing stale.
+        if self.directory:
+            self.baseline_key = (self.directory, self.prerun, self.baseline,
+                                 tuple(self.filenames))
+        else:
+            self.baseline_key = None
+        # The shell commands never change, so build them once.
+        if self.directory:
+            self.script_command = SHELL_CMD + ['../']
+        else:
+            self.script_command = SHELL_CMD + ['']
+        self.baseline_command = SHELL_CMD + self.filenames
+        self.extractor_command = [DTRX_SCRIPT] + self.options + self.filenames
 
     def get_results(self, command, stdin=None):
-        print >>self.outbuffer, "Output from %s:" % (' '.join(command),)
-        self.outbuffer.flush()
-        status = self.start_proc(command, stdin, self.outbuffer).wait()
-        process = subprocess.Popen(['find'], stdout=subprocess.PIPE)
-        output = process.stdout.read(-1)
-        process.stdout.close()
-        process.wait()
-        return status, set(output.split('\n'))
+        print(f"Output from {' '.join(command)}:", file=self.outbuffer)
+        # outbuffer is in memory, so collect the output through a pipe.
+        # Sending stderr into the same pipe keeps both in order.  Tests
+        # without input still get an empty stdin, so dtrx never waits on
+        # the terminal for an answer.
+        process = subprocess.run(command, input=stdin or '',
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT,
+                                 text=True, errors='replace')
+        self.outbuffer.write(process.stdout)
+        status = process.returncode
+        # This lists the same paths `find` would, without starting it.
+        results = {'.'}
+        for path, dirnames, filenames in os.walk('.'):
+            for name in dirnames + filenames:
+                results.add(os.path.join(path, name))
+        return status, results
         
     def run_script(self, key):
         commands = getattr(self, key)
         if commands is not None:
-            if self.directory:
-                directory_hint = '../'
-            else:
-                directory_hint = ''
-            self.start_proc(SHELL_CMD + [directory_hint], commands).wait()
+            subprocess.run(self.script_command, input=commands, text=True)
 
     def get_shell_results(self):
         self.run_script('prerun')
-        return self.get_results(SHELL_CMD + self.filenames, self.baseline)
+        return self.get_results(self.baseline_command, self.baseline)
 
     def get_extractor_results(self):
         self.run_script('prerun')
-        return self.get_results([DTRX_SCRIPT] + self.options + self.filenames,
-                                self.input)
+        return self.get_results(self.extractor_command, self.input)
         
     def get_posttest_result(self):
         if not self.posttest:
             return 0
-        return self.start_proc(SHELL_CMD, self.posttest).wait()
+        return subprocess.run(SHELL_CMD, input=self.posttest,
+                              text=True).returncode
 
     def clean(self):
         self.run_script('cleanup')
         if self.directory:
             target = os.path.join(ROOT_DIR, self.directory)
-            extra_options = []
         else:
             target = ROOT_DIR
-            extra_options = ['(', '(', '-type', 'd',
-                             '!', '-name', 'CVS',
-                             '!', '-name', '.svn', ')',
-                             '-or', '-name', 'test-text',
-                             '-or', '-name', 'test-onefile', ')']
-        status = subprocess.call(['find', target,
-                                  '-mindepth', '1', '-maxdepth', '1'] +
-                                 extra_options +
-                                 ['-exec', 'rm', '-rf', '{}', ';'])
-        if status != 0:
-            raise ExtractorTestError("cleanup exited with status code %s" %
-                                     (status,))
-
+        try:
+            with os.scandir(target) as entries:
+                for entry in entries:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    # In the tests directory itself, only remove what the tests
+                    # make: any directory besides version control's, and the
+                    # files test-text and test-onefile.
+                    if not (self.directory or
+                            (is_dir and (entry.name not in ('CVS', '.svn'))) or
+                            (entry.name in ('test-text', 'test-onefile'))):
+                        continue
+                    if is_dir:
+                        shutil.rmtree(entry.path)
+                    else:
+                        os.unlink(entry.path)
+        except OSError as error:
+            raise ExtractorTestError(f"cleanup failed: {error}")
+
+    # These return the outcome along with the report to show for it, so tests
+    # can run in another process and let the runner do the showing.
     def show_pass(self):
-        self.status_writer.show("Passed %i/%i: %s" %
-                                (self.test_num, NUM_TESTS, self.name))
-        return 'passed'
+        return 'passed', None
 
     def show_report(self, status, message=None):
-        self.status_writer.clear()
-        self.outbuffer.seek(0, 0)
-        sys.stdout.write(self.outbuffer.read(-1))
         if message is None:
             last_part = ''
         else:
-            last_part = ': %s' % (message,)
-        print "%s: %s%s\n" % (status, self.name, last_part)
-        return status.lower()
+            last_part = f': {message}'
+        return status.lower(), (f"{self.outbuffer.getvalue()}"
+                                f"{status}: {self.name}{last_part}\n\n")
 
     def compare_results(self, actual):
         posttest_result = self.get_posttest_result()
         self.clean()
-        status, expected = self.get_shell_results()
-        self.clean()
+        if self.baseline_key in self.baseline_cache:
+            expected = self.baseline_cache[self.baseline_key]
+            print(f"Reusing earlier results from "
+                  f"{' '.join(self.baseline_command)} (output not shown)",
+                  file=self.outbuffer)
+        else:
+            status, expected = self.get_shell_results()
+            self.clean()
+            if self.baseline_key is not None:
+                self.baseline_cache[self.baseline_key] = expected
         if expected != actual:
-            print >>self.outbuffer, "Only in baseline results:"
-            print >>self.outbuffer, '\n'.join(expected.difference(actual))
-            print >>self.outbuffer, "Only in actual results:"
-            print >>self.outbuffer, '\n'.join(actual.difference(expected))
+            print("Only in baseline results:", file=self.outbuffer)
+            print('\n'.join(expected - actual), file=self.outbuffer)
+            print("Only in actual results:", file=self.outbuffer)
+            print('\n'.join(actual - expected), file=self.outbuffer)
             return self.show_report('FAILED')
         elif posttest_result != 0:
-            print >>self.outbuffer, "Posttest gave status code", posttest_result
+            print("Posttest gave status code", posttest_result,
+                  file=self.outbuffer)
             return self.show_report('FAILED')
         return self.show_pass()
     
@@ -192,17 +247,16 @@ class ExtractorTest(object):
         if self.error and (status == 0):
             return "dtrx did not return expected error"
         elif (not self.error) and (status != 0):
-            return "dtrx returned error code %s" % (status,)
+            return f"dtrx returned error code {status}"
         return None
 
     def grep_output(self, output):
-        for pattern in self.grep:
-            if not re.search(pattern.replace(' ', '\\s+'), output,
-                             re.MULTILINE):
-                return "output did not match %s" % (pattern)
-        for pattern in self.antigrep:
-            if re.search(pattern.replace(' ', '\\s+'), output, re.MULTILINE):
-                return "output matched antigrep %s" % (self.antigrep)
+        for pattern, regexp in zip(self.grep, self.grep_res):
+            if not regexp.search(output):
+                return f"output did not match {pattern}"
+        for pattern, regexp in zip(self.antigrep, self.antigrep_res):
+            if regexp.search(output):
+                return f"output matched antigrep {pattern}"
         return None
 
     def check_output(self, output):
@@ -214,9 +268,7 @@ class ExtractorTest(object):
     def check_results(self):
         self.clean()
         status, actual = self.get_extractor_results()
-        self.outbuffer.seek(0, 0)
-        self.outbuffer.readline()
-        output = self.outbuffer.read(-1)
+        output = self.outbuffer.getvalue().split('\n', 1)[1]
         problem = (self.have_error_mismatch(status) or
                    self.check_output(output) or self.grep_output(output))
         if problem:
@@ -228,29 +280,42 @@ class ExtractorTest(object):
             return self.show_pass()
 
     def run(self):
-        self.outbuffer = tempfile.TemporaryFile()
+        self.outbuffer = io.StringIO()
         if self.directory:
             os.mkdir(self.directory)
             os.chdir(self.directory)
         try:
             result = self.check_results()
-        except ExtractorTestError, error:
+        except ExtractorTestError as error:
             result = self.show_report('ERROR', error)
         self.outbuffer.close()
         if self.directory:
             os.chdir(ROOT_DIR)
-            subprocess.call(['chmod', '-R', '700', self.directory])
-            subprocess.call(['rm', '-rf', self.directory])
+            remove_tree(self.directory)
         return result
 
 
+def run_test(test):
+    return test.run()
+
+def use_worker_root(base):
+    # Each pool worker makes its own copy of the tests directory under base,
+    # so tests running at the same time don't see each other's files.  A
+    # worker the pool starts in place of a dead one just makes a new copy.
+    global ROOT_DIR
+    root = os.path.join(tempfile.mkdtemp(dir=base), 'tests')
+    shutil.copytree(ROOT_DIR, root, symlinks=True)
+    ROOT_DIR = root
+    os.chdir(ROOT_DIR)
+
+
 class TestsRunner(object):
     outcomes = ['error', 'failed', 'passed']
 
     def __init__(self):
-        test_db = open('tests.yml')
-        self.test_data = yaml.load(test_db.read(-1))
-        test_db.close()
+        self.status_writer = StatusWriter()
+        with open('tests.yml') as test_db:
+            self.test_data = yaml.load(test_db, Loader=SafeLoader)
         self.name_regexps = [re.compile(s) for s in sys.argv[1:]]
         self.tests = [ExtractorTest(**data) for data in self.test_data
                       if self.wanted_test(data)]
@@ -259,33 +324,66 @@ class TestsRunner(object):
     def wanted_test(self, data):
         if not self.name_regexps:
             return True
-        return filter(None, [r.search(data['name']) for r in self.name_regexps])
+        return any(r.search(data['name']) for r in self.name_regexps)
 
     def add_subdir_tests(self):
         for odata in self.test_data:
-            if ((not self.wanted_test(odata)) or odata.has_key('directory') or
-                (not odata.has_key('baseline'))):
+            # Without filenames there's no ../ path to exercise, so the
+            # copy would just repeat the original test.
+            if ((not self.wanted_test(odata)) or ('directory' in odata) or
+                ('baseline' not in odata) or (not odata.get('filenames'))):
                 continue
             data = odata.copy()
             data['name'] += ' in ..'
             data['directory'] = 'inside-dir'
-            data['filenames'] = ' '.join(['../%s' % filename for filename in
+            data['filenames'] = ' '.join([f'../{filename}' for filename in
                                           data.get('filenames', '').split()])
             self.tests.append(ExtractorTest(**data))
 
+    def show_result(self, results, test, outcome, report):
+        results[outcome] += 1
+        if report is None:
+            self.status_writer.show(
+                f"Passed {test.test_num}/{NUM_TESTS}: {test.name}")
+        else:
+            self.status_writer.clear()
+            sys.stdout.write(report)
+
+    def count_workers(self):
+        return min(os.cpu_count() or 1, len(self.tests))
+
+    def run_parallel(self, workers, results):
+        base = tempfile.mkdtemp(prefix='dtrx-tests-')
+        try:
+            pool = multiprocessing.Pool(workers, use_worker_root, (base,))
+            try:
+                outcomes = pool.imap(run_test, self.tests)
+                for test in self.tests:
+                    outcome, report = next(outcomes)
+                    self.show_result(results, test, outcome, report)
+            finally:
+                pool.terminate()
+                pool.join()
+        finally:
+            remove_tree(base)
+
     def run(self):
-        results = {}
-        for outcome in self.outcomes:
-            results[outcome] = 0
-        for test in self.tests:
-            results[test.run()] += 1
+        results = collections.Counter()
+        workers = self.count_workers()
+        if workers > 1:
+            self.run_parallel(workers, results)
+        else:
+            for test in self.tests:
+                outcome, report = test.run()
+                self.show_result(results, test, outcome, report)
         if self.tests:
-            self.tests[-1].status_writer.clear()
-        print "Totals:", ', '.join(["%s %s" % (results[key], key)
-                                    for key in self.outcomes])
+            self.status_writer.clear()
+        print("Totals:", ', '.join([f"{results[key]} {key}"
+                                    for key in self.outcomes]))
         return (results["error"] + results["failed"]) == 0
 
 
-runner = TestsRunner()
-if not runner.run():
-    sys.exit(1)
+if __name__ == '__main__':
+    runner = TestsRunner()
+    if not runner.run():
+        sys.exit(1)